@@ -17,13 +17,19 @@
 # SHOW_SAMPLE=1
 
 import os
+import re
+import sys
+import html
 import time
+import codecs
 import sqlite3
 from urllib.parse import quote_plus, urlparse
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from selectolax.lexbor import LexborHTMLParser
 from email.message import EmailMessage
 import smtplib
+import atexit
 
 # Optional .env loader
 try:
@@ -47,15 +53,24 @@ EMAIL_TO = os.getenv("EMAIL_TO", SMTP_USER)
 SHOW_SAMPLE = os.getenv("SHOW_SAMPLE", "0") == "1"
 
 HEADERS = {
-    "User-Agent": os.getenv("USER_AGENT", "FirstCryMonitor/1.0 (contact: your_email@example.com)")
+    "User-Agent": os.getenv("USER_AGENT", "FirstCryMonitor/1.0 (contact: your_email@example.com)"),
+    # br is only decoded when the brotli package is installed (see requirements.txt)
+    "Accept-Encoding": "gzip, br",
 }
 # ---------------------------------------------------
 
+# Shared session so repeated fetches reuse the pooled keep-alive connection
+_SESSION = requests.Session()
+_SESSION.headers.update(HEADERS)
+_SESSION.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=0))
+
 def requests_get_with_retry(url, headers=None, timeout=20, retries=2, backoff=2):
     last_exc = None
     for attempt in range(1, retries + 2):
         try:
-            r = requests.get(url, headers=headers, timeout=timeout)
+            r = _SESSION.get(url, headers=headers, timeout=timeout)
+            if r.status_code == 304:
+                return None
             r.raise_for_status()
             return r
         except Exception as e:
@@ -70,6 +85,9 @@ def requests_get_with_retry(url, headers=None, timeout=20, retries=2, backoff=2)
 def ensure_db():
     conn = sqlite3.connect(DB_PATH)
     c = conn.cursor()
+    c.execute("PRAGMA journal_mode=WAL")
+    c.execute("PRAGMA synchronous=NORMAL")
+    c.execute("PRAGMA temp_store=MEMORY")
     c.execute("""
         CREATE TABLE IF NOT EXISTS products (
             product_id TEXT PRIMARY KEY,
@@ -77,89 +95,192 @@ def ensure_db():
             last_seen INTEGER
         )
     """)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    """)
     conn.commit()
     return conn
 
+def get_meta(conn, key):
+    row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+def set_meta(conn, items):
+    conn.executemany("""
+        INSERT INTO meta (key, value) VALUES (?, ?)
+        ON CONFLICT(key) DO UPDATE SET value = excluded.value
+    """, items)
+
 def build_fetch_url(query):
     if query.lower().startswith("http://") or query.lower().startswith("https://"):
         return query
     return FIRSTCRY_SEARCH_URL + quote_plus(query)
 
-def fetch_search_html(query):
+def fetch_search_html(query, conn=None):
+    """
+    Conditional GET using the ETag / Last-Modified stored by the previous run.
+    Returns (content, validators); content is None on 304 Not Modified.
+    """
     url = build_fetch_url(query)
     print("Fetching URL:", url)
-    r = requests_get_with_retry(url, headers=HEADERS)
-    return r.text
+    etag_key, lastmod_key = "etag_" + url, "lastmod_" + url
+    headers = {}
+    # Without a recorded scan time a 304 can't tell which products to refresh
+    if conn is not None and get_meta(conn, "lastscan_" + url) is not None:
+        etag = get_meta(conn, etag_key)
+        lastmod = get_meta(conn, lastmod_key)
+        if etag:
+            headers["If-None-Match"] = etag
+        if lastmod:
+            headers["If-Modified-Since"] = lastmod
+    r = requests_get_with_retry(url, headers=headers)
+    if r is None:
+        return None, {}
+    validators = {}
+    if r.headers.get("ETag"):
+        validators[etag_key] = r.headers["ETag"]
+    if r.headers.get("Last-Modified"):
+        validators[lastmod_key] = r.headers["Last-Modified"]
+    # Lexbor always reads bytes as UTF-8 (it ignores <meta charset>), so only
+    # decode here when the response header declares some other charset.
+    # r.encoding alone isn't enough: requests assumes ISO-8859-1 for text/html.
+    if "charset=" in r.headers.get("Content-Type", "").lower() and r.encoding:
+        try:
+            if codecs.lookup(r.encoding).name != "utf-8":
+                return r.content.decode(r.encoding, "replace"), validators
+        except LookupError:
+            pass
+    return r.content, validators
 
-def parse_products_from_html(html_text):
-    """
-    Tuned parser:
-      - Primary: links containing '/hotwheels/' (category pages)
-      - Secondary: links containing '/product/'
-      - Tertiary: data-product-id attributes
-      - Final fallback: meaningful <a> text with path segments
-    Returns list of (product_id, title)
-    """
-    soup = BeautifulSoup(html_text, "html.parser")
+# Selectors tried in order for a data-product-id tile's title
+_TITLE_SELECTORS = ("a", ".product-name", "h2", "h3")
+
+# Fast path: '/hotwheels/' anchors whose only content is their text
+_FAST_RE = re.compile(rb'href="([^"]*/hotwheels/[^"]*)"[^>]*>([^<]{4,200})</a>')
+# Every '/hotwheels/' href in the page, however the anchor's content is marked up
+_HOTWHEELS_HREF_RE = re.compile(rb"""href\s*=\s*["']?[^"'\s>]*/hotwheels/""")
+# Comments and raw-text elements, whose anchors a DOM parser never sees as links
+_NON_MARKUP_RE = re.compile(
+    rb"<!--.*?(?:-->|\Z)|<(script|style|template|textarea|noscript)\b.*?(?:</\1\s*>|\Z)", re.S | re.I
+)
+# Fewer regex hits than this means the markup changed; use the full parser
+_FAST_MIN_RESULTS = 5
+
+def _pid(href):
+    # Last non-empty path segment, ignoring any query string or fragment.
+    # Interned so repeated links to the same product share one string.
+    return sys.intern(href.split("?", 1)[0].split("#", 1)[0].rstrip("/").rsplit("/", 1)[-1] or href)
+
+def _fallback_pid(href):
+    # Baseline id rule for fallback-tier links; stored ids depend on it, so
+    # trailing-slash and off-site links keep resolving to the full href.
+    return sys.intern(urlparse(href).path.split("/")[-1].split("?")[0] or href)
+
+def _parse_with_regex(content):
     products = []
+    for href, text in _FAST_RE.findall(content):
+        title = " ".join(html.unescape(text.decode("utf-8", "replace")).split())
+        if title:
+            products.append((_pid(href.decode("utf-8", "replace").strip()), title))
+    return products
+
+def _parse_with_tree(content):
+    tree = LexborHTMLParser(content)
+    primary, secondary, fallback = [], [], []
 
-    # Primary: '/hotwheels/' links
-    for a in soup.find_all("a", href=True):
-        href = a["href"].strip()
-        text = a.get_text(strip=True)
+    # Single pass over the anchors, bucketing each into its tier
+    for a in tree.css("a[href]"):
+        href = (a.attributes.get("href") or "").strip()
+        text = a.text(deep=True, strip=True)
         if not text:
             continue
         if "/hotwheels/" in href:
-            parsed = urlparse(href)
-            path = parsed.path
-            parts = [p for p in path.split("/") if p]
-            pid = parts[-1] if parts else path
-            title = " ".join(text.split())
-            products.append((pid, title))
-
-    # Secondary: '/product/' links
-    if not products:
-        for a in soup.find_all("a", href=True):
-            href = a["href"].strip()
-            text = a.get_text(strip=True)
-            if not text:
-                continue
-            if "/product/" in href:
-                parsed = urlparse(href)
-                path = parsed.path
-                parts = [p for p in path.split("/") if p]
-                pid = parts[-1] if parts else path
-                title = " ".join(text.split())
-                products.append((pid, title))
-
-    # Tertiary: data-product-id attributes
+            primary.append((_pid(href), " ".join(text.split())))
+        elif "/product/" in href:
+            secondary.append((_pid(href), " ".join(text.split())))
+        elif len(text) >= 4 and "javascript" not in href.lower():
+            fallback.append((_fallback_pid(href), text))
+
+    products = primary or secondary
+
+    # Tertiary: data-product-id attributes (only walked when no product links matched)
     if not products:
-        for tile in soup.select("[data-product-id]"):
-            pid = tile.get("data-product-id")
-            title_tag = tile.select_one("a") or tile.select_one(".product-name") or tile.select_one("h2") or tile.select_one("h3")
-            title = title_tag.get_text(strip=True) if title_tag else ""
+        for tile in tree.css("[data-product-id]"):
+            pid = tile.attributes.get("data-product-id")
+            title_tag = None
+            for sel in _TITLE_SELECTORS:
+                title_tag = tile.css_first(sel)
+                if title_tag:
+                    break
+            title = title_tag.text(deep=True, strip=True) if title_tag else ""
             if pid:
-                products.append((pid.strip(), title.strip()))
+                products.append((sys.intern(pid.strip()), title.strip()))
 
     # Final fallback: any <a> with visible text (avoid tiny labels)
     if not products:
-        for a in soup.find_all("a", href=True):
-            href = a["href"].strip()
-            text = a.get_text(strip=True)
-            if not text or len(text) < 4:
-                continue
-            if "javascript" in href.lower():
-                continue
-            pid = urlparse(href).path.split("/")[-1].split("?")[0] or href
-            products.append((pid, text))
-
-    # Deduplicate preserving first seen title
-    unique = {}
-    for pid, title in products:
-        if pid and pid not in unique:
-            unique[pid] = title
-
-    return [(pid, unique[pid]) for pid in unique]
+        products = fallback
+    return products
+
+def parse_products_from_html(content):
+    """
+    Tuned parser:
+      - Fast path: regex over the raw bytes for '/hotwheels/' text links
+      - Primary: links containing '/hotwheels/' (category pages)
+      - Secondary: links containing '/product/'
+      - Tertiary: data-product-id attributes
+      - Final fallback: meaningful <a> text with path segments
+    The fast path is only trusted when it matched every '/hotwheels/' href;
+    nested markup (e.g. <a><img><span>title</span></a>) forces the DOM tiers.
+    Returns list of (product_id, title); ids may repeat, main() dedupes in SQL
+    """
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    markup = _NON_MARKUP_RE.sub(b"", content)
+    products = _parse_with_regex(markup)
+    if len(products) < _FAST_MIN_RESULTS or len(products) < len(_HOTWHEELS_HREF_RE.findall(markup)):
+        products = _parse_with_tree(content)
+    return products
+
+# Authenticated SMTP connection, reused across send_email() calls in one run
+_smtp_conn = None
+
+def _get_smtp():
+    global _smtp_conn
+    if _smtp_conn is not None:
+        try:
+            # noop() returns error replies (e.g. 421) instead of raising
+            if _smtp_conn.noop()[0] == 250:
+                return _smtp_conn
+        except (smtplib.SMTPException, OSError):
+            pass
+        _close_smtp()
+    s = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=30)
+    try:
+        s.ehlo()
+        if SMTP_PORT == 587:
+            s.starttls()
+            s.ehlo()
+        s.login(SMTP_USER, SMTP_PASS)
+    except BaseException:
+        # Don't leak the socket when the handshake or login fails
+        s.close()
+        raise
+    _smtp_conn = s
+    return s
+
+def _close_smtp():
+    global _smtp_conn
+    if _smtp_conn is not None:
+        try:
+            _smtp_conn.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+        _smtp_conn = None
+
+atexit.register(_close_smtp)
 
 def send_email(subject, body):
     if not SMTP_HOST or not SMTP_USER or not SMTP_PASS or not EMAIL_TO:
@@ -172,48 +293,79 @@ def send_email(subject, body):
     msg["Subject"] = subject
     msg.set_content(body)
 
-    with smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=30) as s:
-        s.ehlo()
-        if SMTP_PORT == 587:
-            s.starttls()
-            s.ehlo()
-        s.login(SMTP_USER, SMTP_PASS)
-        s.send_message(msg)
+    try:
+        _get_smtp().send_message(msg)
+    except smtplib.SMTPServerDisconnected:
+        # Server dropped the cached connection between the NOOP and the send
+        _close_smtp()
+        _get_smtp().send_message(msg)
     print("Email sent:", subject)
 
 def main():
+    conn = None
     try:
         print("="*40)
         print(f"FirstCry Monitor — query: '{SEARCH_QUERY}'")
         conn = ensure_db()
         c = conn.cursor()
 
-        html_text = fetch_search_html(SEARCH_QUERY)
-        if not html_text or len(html_text) < 100:
+        content, validators = fetch_search_html(SEARCH_QUERY, conn)
+        now = int(time.time())
+        scan_key = "lastscan_" + build_fetch_url(SEARCH_QUERY)
+
+        if content is None:
+            # Unchanged page: the products stored by this URL's last scan are still listed
+            with conn:
+                c.execute("BEGIN IMMEDIATE")
+                last_scan = get_meta(conn, scan_key)
+                if last_scan is not None:
+                    c.execute("UPDATE products SET last_seen = ? WHERE last_seen = ?", (now, int(last_scan)))
+                    set_meta(c, [(scan_key, str(now))])
+            print("Page not modified since last run — skipping parse.")
+            print("Run complete.")
+            return
+
+        if not content or len(content) < 100:
             raise RuntimeError("Fetched HTML is suspiciously small — possible blocking or incorrect URL.")
 
-        products = parse_products_from_html(html_text)
+        products = parse_products_from_html(content)
 
-        if SHOW_SAMPLE:
-            print("First 10 parsed products (sample):")
-            for i, (pid, title) in enumerate(products[:10], start=1):
-                print(f"{i}. {title} — id: {pid}")
+        with conn:
+            c.execute("BEGIN IMMEDIATE")
+            c.execute("SELECT COUNT(*) FROM products")
+            prev_count = c.fetchone()[0]
 
-        now = int(time.time())
-        c.execute("SELECT COUNT(*) FROM products")
-        prev_count = c.fetchone()[0]
-
-        new_found = []
-        for pid, title in products:
-            c.execute("SELECT product_id FROM products WHERE product_id = ?", (pid,))
-            if c.fetchone() is None:
-                c.execute("INSERT OR REPLACE INTO products (product_id, title, last_seen) VALUES (?, ?, ?)",
-                          (pid, title, now))
-                new_found.append((pid, title))
-            else:
-                c.execute("UPDATE products SET last_seen = ? WHERE product_id = ?", (now, pid))
-        conn.commit()
-        curr_count = len(products)
+            # The temp table's primary key dedupes ids, keeping the first seen title
+            c.execute("CREATE TEMP TABLE scanned (product_id TEXT PRIMARY KEY, title TEXT)")
+            c.executemany("INSERT OR IGNORE INTO scanned (product_id, title) VALUES (?, ?)",
+                          ((pid, title) for pid, title in products if pid))
+            c.execute("SELECT COUNT(*) FROM scanned")
+            curr_count = c.fetchone()[0]
+
+            if SHOW_SAMPLE:
+                print("First 10 parsed products (sample):")
+                c.execute("SELECT product_id, title FROM scanned ORDER BY rowid LIMIT 10")
+                for i, (pid, title) in enumerate(c.fetchall(), start=1):
+                    print(f"{i}. {title} — id: {pid}")
+
+            c.execute("""
+                SELECT s.product_id, s.title FROM scanned s
+                LEFT JOIN products p USING (product_id)
+                WHERE p.product_id IS NULL
+                ORDER BY s.rowid
+            """)
+            new_found = c.fetchall()
+
+            # WHERE true disambiguates the ON CONFLICT clause from a join constraint
+            c.execute("""
+                INSERT INTO products (product_id, title, last_seen)
+                SELECT product_id, title, ? FROM scanned WHERE true
+                ON CONFLICT(product_id) DO UPDATE SET last_seen = excluded.last_seen
+            """, (now,))
+            # An empty scan (e.g. markup drift) must not be cached behind a 304
+            if curr_count:
+                set_meta(c, list(validators.items()) + [(scan_key, str(now))])
+            c.execute("DROP TABLE scanned")
 
         print(f"Parsed products: {curr_count} (previous stored: {prev_count})")
 
@@ -235,6 +387,10 @@ def main():
             send_email(f"[FirstCry Monitor] Error for {SEARCH_QUERY}", repr(e))
         except Exception:
             pass
+    finally:
+        # Closing checkpoints the WAL back into the main DB file
+        if conn is not None:
+            conn.close()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,181 @@
+import sqlite3
+
+import requests
+
+import monitor_firstcry
+from monitor_firstcry import parse_products_from_html
+
+CATEGORY_LINKS = "".join(
+    f'<a href="/hotwheels/category-{i}/5/0/{i}">Hot Wheels Category {i}</a>' for i in range(5)
+)
+PRODUCT_TILES = "".join(
+    f'<a href="/hotwheels/car-{i}/product-detail/{1000 + i}">'
+    f'<img src="/img/{i}.jpg"><span>Hot Wheels Car {i}</span></a>'
+    for i in range(20)
+)
+
+
+def test_nested_markup_anchors_are_not_dropped_by_fast_path():
+    page = f"<html><body><nav>{CATEGORY_LINKS}</nav>{PRODUCT_TILES}</body></html>".encode()
+    ids = {pid for pid, _ in parse_products_from_html(page)}
+    assert len(ids) == 25
+    assert {str(1000 + i) for i in range(20)} <= ids
+
+
+def test_plain_text_anchors_use_fast_path(monkeypatch):
+    def no_tree(content):
+        raise AssertionError("fast path should have served this page")
+
+    monkeypatch.setattr(monitor_firstcry, "_parse_with_tree", no_tree)
+    page = f"<html><body>{CATEGORY_LINKS}</body></html>".encode()
+    products = parse_products_from_html(page)
+    assert products == [(str(i), f"Hot Wheels Category {i}") for i in range(5)]
+
+
+def test_anchors_in_comments_and_raw_text_blocks_are_ignored():
+    hidden = "".join(
+        f'<a href="/hotwheels/hidden-{i}/9/0/{900 + i}">Hidden Hot Wheels {i}</a>' for i in range(5)
+    )
+    for wrapper in (
+        "<!-- {} -->",
+        '<script type="text/template">{}</script>',
+        "<textarea>{}</textarea>",
+    ):
+        page = f"<html><body>{wrapper.format(hidden)}</body></html>".encode()
+        assert parse_products_from_html(page) == []
+
+    # Hidden copies must not mask real links either
+    page = f"<html><body><!-- {hidden} -->{CATEGORY_LINKS}</body></html>".encode()
+    assert [pid for pid, _ in parse_products_from_html(page)] == [str(i) for i in range(5)]
+
+
+def test_fallback_tier_keeps_baseline_ids():
+    page = (
+        b'<a href="https://www.firstcry.com/intelli/intellitots/preschool-near-you/?ref2=topstrip">Find Preschools</a>'
+        b'<a href="https://www.linkedin.com/company/firstcry/">Linkedin</a>'
+        b'<a href="/store-locator?ref=nav">Find Stores</a>'
+    )
+    assert parse_products_from_html(page) == [
+        ("https://www.firstcry.com/intelli/intellitots/preschool-near-you/?ref2=topstrip", "Find Preschools"),
+        ("https://www.linkedin.com/company/firstcry/", "Linkedin"),
+        ("store-locator", "Find Stores"),
+    ]
+
+
+def _response(content, status=200, headers=None, encoding=None):
+    r = requests.Response()
+    r.status_code = status
+    r._content = content
+    r.headers.update(headers or {})
+    r.encoding = encoding
+    return r
+
+
+def test_non_utf8_charset_from_header_is_decoded(monkeypatch):
+    page = "<a href='/x/cafe'>café long</a>".encode("windows-1252")
+    resp = _response(page, headers={"Content-Type": "text/html; charset=windows-1252"}, encoding="windows-1252")
+    monkeypatch.setattr(monitor_firstcry._SESSION, "get", lambda *a, **k: resp)
+    content, _ = monitor_firstcry.fetch_search_html("https://www.firstcry.com/x")
+    assert parse_products_from_html(content) == [("cafe", "café long")]
+
+
+def test_conditional_get_across_runs(monkeypatch, tmp_path):
+    db_path = str(tmp_path / "monitor.db")
+    url = monitor_firstcry.build_fetch_url(monitor_firstcry.SEARCH_QUERY)
+    product_page = (b"<html>" + b" " * 100 + b'<a href="/hotwheels/car/1001">Hot Wheels Car</a></html>')
+    empty_page = b"<html>" + b" " * 100 + b"</html>"
+    responses = iter([
+        _response(product_page, headers={"ETag": '"v1"'}),
+        _response(b"", status=304),
+        _response(empty_page, headers={"ETag": '"v2"'}),
+        _response(b"", status=304),
+    ])
+    sent_headers = []
+
+    def fake_get(url, headers=None, timeout=None):
+        sent_headers.append(dict(headers or {}))
+        return next(responses)
+
+    clock = iter([1000, 2000, 3000, 4000])
+    emails = []
+    monkeypatch.setattr(monitor_firstcry, "DB_PATH", db_path)
+    monkeypatch.setattr(monitor_firstcry._SESSION, "get", fake_get)
+    monkeypatch.setattr(monitor_firstcry.time, "time", lambda: next(clock))
+    monkeypatch.setattr(monitor_firstcry, "send_email", lambda subject, body: emails.append(subject))
+
+    def state():
+        conn = sqlite3.connect(db_path)
+        try:
+            meta = dict(conn.execute("SELECT key, value FROM meta"))
+            last_seen = dict(conn.execute("SELECT product_id, last_seen FROM products"))
+        finally:
+            conn.close()
+        return meta, last_seen
+
+    # 200 with an ETag: full scan, validators and scan time stored
+    monitor_firstcry.main()
+    assert sent_headers[-1] == {}
+    assert state() == ({"etag_" + url: '"v1"', "lastscan_" + url: "1000"}, {"1001": 1000})
+
+    # 304: only the previous scan's rows are refreshed
+    monitor_firstcry.main()
+    assert sent_headers[-1] == {"If-None-Match": '"v1"'}
+    assert state() == ({"etag_" + url: '"v1"', "lastscan_" + url: "2000"}, {"1001": 2000})
+
+    # 200 that parses to nothing: validators and scan time are left alone
+    monitor_firstcry.main()
+    assert sent_headers[-1] == {"If-None-Match": '"v1"'}
+    assert state() == ({"etag_" + url: '"v1"', "lastscan_" + url: "2000"}, {"1001": 2000})
+
+    # 304 again: still keyed off the last non-empty scan
+    monitor_firstcry.main()
+    assert sent_headers[-1] == {"If-None-Match": '"v1"'}
+    assert state() == ({"etag_" + url: '"v1"', "lastscan_" + url: "4000"}, {"1001": 4000})
+
+    assert not [subject for subject in emails if "Error" in subject]
+
+
+def test_smtp_reconnects_when_noop_returns_an_error_reply(monkeypatch):
+    connections = []
+
+    class FakeSMTP:
+        def __init__(self, *args, **kwargs):
+            self.noop_code = 250
+            self.sent = []
+            self.closed = False
+            connections.append(self)
+
+        def ehlo(self):
+            pass
+
+        def starttls(self):
+            pass
+
+        def login(self, user, password):
+            pass
+
+        def noop(self):
+            return (self.noop_code, b"")
+
+        def send_message(self, msg):
+            self.sent.append(msg["Subject"])
+
+        def quit(self):
+            self.closed = True
+
+    monkeypatch.setattr(monitor_firstcry.smtplib, "SMTP", FakeSMTP)
+    monkeypatch.setattr(monitor_firstcry, "_smtp_conn", None)
+    for name in ("SMTP_USER", "SMTP_PASS", "EMAIL_TO"):
+        monkeypatch.setattr(monitor_firstcry, name, "user@example.com")
+
+    monitor_firstcry.send_email("first", "body")
+    monitor_firstcry.send_email("second", "body")
+    assert len(connections) == 1
+
+    connections[0].noop_code = 421
+    monitor_firstcry.send_email("third", "body")
+    assert len(connections) == 2
+    assert connections[0].closed
+    assert connections[0].sent == ["first", "second"]
+    assert connections[1].sent == ["third"]
+    monitor_firstcry._close_smtp()